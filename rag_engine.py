@@ -1,22 +1,51 @@
 import os
 import json
-import mysql.connector
 from dotenv import load_dotenv
-import ollama
-import tkinter as tk
-from tkinter import scrolledtext
+import asyncio
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import heapq
+from functools import lru_cache
+from itertools import chain
+from contextlib import closing
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
 import re
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sql_batcher import batcher
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # =========================================================
 # Logging
 # =========================================================
-logging.basicConfig(
-    filename="chatbot.log",
-    filemode="a",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+# Records are handed to a QueueListener thread so the file write never
+# blocks the caller. The guard keeps reruns from stacking handlers.
+_root_logger = logging.getLogger()
+if not any(isinstance(h, QueueHandler) for h in _root_logger.handlers):
+    _file_handler = RotatingFileHandler(
+        "chatbot.log",
+        maxBytes=5 * 1024 * 1024,
+        backupCount=3,
+        encoding="utf-8"
+    )
+    _file_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+    _log_queue = queue.Queue(-1)
+    _log_listener = QueueListener(_log_queue, _file_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+    _root_logger.addHandler(QueueHandler(_log_queue))
+    _root_logger.setLevel(logging.INFO)
+
 logger = logging.getLogger(__name__)
 
 # =========================================================
@@ -30,12 +59,19 @@ DB_DATABASE = os.getenv("DB_DATABASE")
 DB_USERNAME = os.getenv("DB_USERNAME")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
+if os.getenv("DEBUG"):
+    print("DB_HOST:", DB_HOST)
+    print("DB_PORT:", DB_PORT)
+    print("DB_DATABASE:", DB_DATABASE)
+    print("DB_USERNAME:", DB_USERNAME)
+
 # =========================================================
 # Load Table Metadata (HARDENED)
 # =========================================================
 try:
-    with open("table_metadata.json", "r", encoding="utf-8") as f:
-        TABLE_METADATA = json.load(f)
+    with open("table_metadata.json", "rb") as f:
+        raw = f.read()
+    TABLE_METADATA = orjson.loads(raw) if orjson else json.loads(raw)
 except Exception as e:
     logger.critical(f"Failed to load table_metadata.json: {e}")
     raise SystemExit("table_metadata.json missing or corrupted")
@@ -46,61 +82,118 @@ if isinstance(TABLE_METADATA, dict):
 # =========================================================
 # Intent Detection
 # =========================================================
+_RANKING_RE = re.compile(
+    r"\b(top|highest|lowest|most|least|maximum|minimum"
+    r"|rank(?:s|ed|ing|ings)?|order(?:s|ed|ing)?)\b",
+    re.IGNORECASE
+)
+
 def is_ranking_query(query: str) -> bool:
-    return any(
-        k in query.lower()
-        for k in ["top", "highest", "lowest", "most", "least",
-                  "maximum", "minimum", "rank", "order"]
-    )
+    return _RANKING_RE.search(query) is not None
 
 # =========================================================
 # SAFE TABLE SELECTION (FIXED)
 # =========================================================
+def _table_keywords(table) -> frozenset:
+    table_name = str(table.get("table_name", "")).lower()
+    description = str(table.get("description", "")).lower()
+    columns = []
+    for c in table.get("columns", []):
+        if isinstance(c, dict) and "name" in c:
+            columns.append(c["name"].lower())
+        elif isinstance(c, str):
+            columns.append(c.lower())
+        else:
+            logger.warning(f"Invalid column format in {table_name}: {c}")
+    return frozenset(table_name.split() + description.split() + columns)
+
+# Built once at import. Every distinct keyword gets a bit, and each table
+# becomes an int bitmask, so scoring a query is an AND plus a popcount.
+_VOCAB = {}
+_TABLE_INDEX = [
+    (sum(1 << _VOCAB.setdefault(w, len(_VOCAB)) for w in _table_keywords(t)), t)
+    for t in TABLE_METADATA
+]
+
+def _query_mask(query: str) -> int:
+    mask = 0
+    for w in query.lower().split():
+        bit = _VOCAB.get(w)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+@lru_cache(maxsize=1024)
 def select_relevant_tables(query: str):
-    query_words = set(query.lower().split())
-    scored = []
-
-    for table in TABLE_METADATA:
-        table_name = str(table.get("table_name", "")).lower()
-        description = str(table.get("description", "")).lower()
-
-        raw_columns = table.get("columns", [])
-        columns = []
-
-        for c in raw_columns:
-            if isinstance(c, dict) and "name" in c:
-                columns.append(c["name"].lower())
-            elif isinstance(c, str):
-                columns.append(c.lower())
-            else:
-                logger.warning(f"Invalid column format in {table_name}: {c}")
-
-        keywords = set(table_name.split() + description.split() + columns)
-        score = len(query_words.intersection(keywords))
-
-        if score > 0:
-            scored.append((score, table))
+    qmask = _query_mask(query)
+    scored = [
+        ((qmask & mask).bit_count(), table)
+        for mask, table in _TABLE_INDEX
+        if qmask & mask
+    ]
 
     if not scored:
-        return TABLE_METADATA[:3]
+        return tuple(TABLE_METADATA[:3])
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [t for _, t in scored[:3]]
+    return tuple(t for _, t in heapq.nlargest(3, scored, key=lambda x: x[0]))
 
 # =========================================================
 # SQL GENERATION
 # =========================================================
-def generate_sql_query(user_query: str):
-    tables = select_relevant_tables(user_query)
+_FENCE_RE = re.compile(r"```.*?```", re.DOTALL)
+_SELECT_RE = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+
+_TABLE_BY_NAME = {t["table_name"]: t for t in TABLE_METADATA}
+
+@lru_cache(maxsize=256)
+def _schema_for(table_names: tuple[str, ...]) -> str:
+    parts = ["MySQL Schema:"]
+    for name in table_names:
+        parts.append(f"\nTable: {name}")
+        parts.extend(
+            f"  - {c['name']} ({c.get('type','')})" if isinstance(c, dict)
+            else f"  - {c}"
+            for c in _TABLE_BY_NAME[name].get("columns", [])
+            if isinstance(c, (dict, str))
+        )
+    return "\n".join(parts)
+
+# Generated SQL keyed by the normalized question, so verbatim repeats
+# (ignoring case and whitespace) skip the Ollama round-trip
+SQL_CACHE_SIZE = 256
+_SQL_CACHE = OrderedDict()
+_SQL_CACHE_LOCK = threading.Lock()
+
+def _normalize_query(user_query: str) -> str:
+    return " ".join(user_query.lower().split())
+
+def _cached_sql(key: str):
+    with _SQL_CACHE_LOCK:
+        sql = _SQL_CACHE.get(key)
+        if sql is not None:
+            _SQL_CACHE.move_to_end(key)
+        return sql
+
+def _remember_sql(key: str, sql: str):
+    with _SQL_CACHE_LOCK:
+        _SQL_CACHE[key] = sql
+        _SQL_CACHE.move_to_end(key)
+        if len(_SQL_CACHE) > SQL_CACHE_SIZE:
+            _SQL_CACHE.popitem(last=False)
+
+# Concurrent requests only overlap if the Ollama server allows it:
+#   OLLAMA_NUM_PARALLEL=4 OLLAMA_MAX_LOADED_MODELS=2 ollama serve
+async def generate_sql_query(user_query: str, on_chunk=None):
+    key = _normalize_query(user_query)
+    sql = _cached_sql(key)
+    if sql is not None:
+        # Streaming callers still expect to see the SQL
+        if on_chunk is not None:
+            on_chunk(sql)
+        return sql, None
 
-    schema = "MySQL Schema:\n"
-    for t in tables:
-        schema += f"\nTable: {t['table_name']}\n"
-        for c in t.get("columns", []):
-            if isinstance(c, dict):
-                schema += f"  - {c['name']} ({c.get('type','')})\n"
-            elif isinstance(c, str):
-                schema += f"  - {c}\n"
+    tables = select_relevant_tables(user_query)
+    schema = _schema_for(tuple(t["table_name"] for t in tables))
 
     prompt = f"""
 You are a senior MySQL expert.
@@ -118,37 +211,122 @@ Rules:
 """
 
     try:
-        response = ollama.chat(
-            model="mistral",
-            messages=[{"role": "user", "content": prompt}]
-        )
-
-        sql = response["message"]["content"].strip()
-        sql = re.sub(r"```.*?```", "", sql, flags=re.DOTALL).strip()
-
+        if on_chunk is None:
+            sql = await batcher.submit(prompt)
+        else:
+            sql = await batcher.stream(prompt, on_chunk)
+
+        # Fences can span chunks, so strip them once the stream is complete
+        sql = _FENCE_RE.sub("", sql).strip()
+        if not _SELECT_RE.match(sql):
+            logger.warning(f"Rejected non-SELECT output: {sql}")
+            return None, "Generated query is not a SELECT statement"
+
+        _remember_sql(key, sql)
         return sql, None
     except Exception as e:
         logger.error(f"Ollama failure: {e}")
         return None, str(e)
 
+async def generate_sql_queries_bulk(queries: list[str]):
+    return await asyncio.gather(*[generate_sql_query(q) for q in queries])
+
 # =========================================================
 # EXECUTE SQL
 # =========================================================
-def execute_sql(sql: str):
-    try:
-        conn = mysql.connector.connect(
+_POOL = None
+
+def _get_pool():
+    global _POOL
+    if _POOL is None:
+        from mysql.connector import pooling
+
+        _POOL = pooling.MySQLConnectionPool(
+            pool_name="rag",
+            pool_size=8,
             host=DB_HOST,
             port=DB_PORT,
             database=DB_DATABASE,
             user=DB_USERNAME,
-            password=DB_PASSWORD
+            password=DB_PASSWORD,
+            # Drains rows left unread when a result stream is abandoned
+            consume_results=True,
+            # Keep sessions (and their prepared statements) intact when a
+            # connection goes back to the pool
+            pool_reset_session=False
         )
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-        columns = [d[0] for d in cursor.description]
-        conn.close()
-        return rows, columns, None
+    return _POOL
+
+FETCH_SIZE = 1000
+PREPARED_PER_CONNECTION = 32
+
+# Physical connection -> (connection_id, {sql: prepared cursor})
+_PREPARED = WeakKeyDictionary()
+
+def _statement_cache(conn):
+    # Keyed on the pooled wrapper's underlying connection, not the server
+    # session id: ids are reused after a server restart. A reconnect gives
+    # the same object a new session, whose statements start empty, so the
+    # stale cursors are dropped without being closed.
+    # PooledMySQLConnection has no public accessor for the underlying
+    # connection, and close() sets _cnx to None, so this must only be
+    # called while conn is checked out (i.e. before conn.close()).
+    cnx = conn._cnx
+    entry = _PREPARED.get(cnx)
+    if entry is None or entry[0] != cnx.connection_id:
+        entry = (cnx.connection_id, OrderedDict())
+        _PREPARED[cnx] = entry
+    return entry[1]
+
+def _prepared_cursor(conn, sql: str):
+    # Re-executing the same text on a cached prepared cursor skips the
+    # server-side parse and plan
+    cache = _statement_cache(conn)
+    cursor = cache.pop(sql, None)
+    if cursor is None:
+        cursor = conn.cursor(prepared=True)
+        if len(cache) >= PREPARED_PER_CONNECTION:
+            _, evicted = cache.popitem(last=False)
+            evicted.close()
+    cache[sql] = cursor
+    return cursor
+
+def _discard_cursor(conn, sql: str, cursor):
+    _statement_cache(conn).pop(sql, None)
+    cursor.close()
+
+def _stream_rows(conn, cursor, sql: str):
+    # Closing the pooled connection returns it to the pool. The prepared
+    # cursor stays cached unless the stream was abandoned part-way.
+    exhausted = False
+    with closing(conn):
+        try:
+            yield from chain.from_iterable(
+                iter(lambda: cursor.fetchmany(FETCH_SIZE), [])
+            )
+            exhausted = True
+        finally:
+            if not exhausted:
+                _discard_cursor(conn, sql, cursor)
+
+def execute_sql(sql: str):
+    # Imported on first use so the module stays cheap to import
+    import mysql.connector
+
+    try:
+        conn = _get_pool().get_connection()
+        try:
+            cursor = _prepared_cursor(conn, sql)
+            try:
+                cursor.execute(sql)
+                columns = [d[0] for d in cursor.description]
+            except BaseException:
+                _discard_cursor(conn, sql, cursor)
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        return _stream_rows(conn, cursor, sql), columns, None
     except mysql.connector.Error as e:
         logger.error(f"MySQL error: {e}")
         return None, None, str(e)
@@ -157,46 +335,92 @@ def execute_sql(sql: str):
 # ANSWER FORMATTING
 # =========================================================
 def frame_answer(query, rows, cols):
-    if not rows:
-        return "No results found."
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        yield "No results found."
+        return
 
+    fmt_cell = "{0[0]}: {0[1]}".format
     ranking = is_ranking_query(query)
-    text = ""
-
-    for i, row in enumerate(rows, 1):
-        line = ", ".join(f"{c}: {v}" for c, v in zip(cols, row))
-        text += f"Rank {i}: {line}\n" if ranking else line + "\n"
 
-    return text.strip()
+    for i, row in enumerate(chain((first,), rows), 1):
+        line = ", ".join(map(fmt_cell, zip(cols, row)))
+        yield f"Rank {i}: {line}" if ranking else line
 
 # =========================================================
 # TKINTER UI
 # =========================================================
+_EXEC = ThreadPoolExecutor(max_workers=4)
+
+def _pipeline(user_query: str, out: queue.Queue):
+    out.put("SQL:\n")
+    sql, err = asyncio.run(generate_sql_query(user_query, on_chunk=out.put))
+    out.put("\n\n")
+    if err:
+        out.put(f"Error: {err}\n")
+        return
+
+    rows, cols, db_err = execute_sql(sql)
+    if db_err:
+        out.put(f"DB Error: {db_err}\n")
+        return
+
+    # Rows are fetched lazily, so a lost connection surfaces here rather
+    # than inside execute_sql
+    import mysql.connector
+
+    out.put("Bot:\n")
+    try:
+        for line in frame_answer(user_query, rows, cols):
+            out.put(line + "\n")
+    except mysql.connector.Error as e:
+        logger.error(f"MySQL error: {e}")
+        out.put(f"DB Error: {e}\n")
+
 def chatbot_ui():
+    import tkinter as tk
+    from tkinter import scrolledtext
+
+    def poll(fut, out, mark):
+        # Runs on the Tk thread; only this side touches the widgets.
+        # Check done() before draining so no trailing chunk is missed.
+        done = fut.done()
+        while True:
+            try:
+                output.insert(mark, out.get_nowait())
+            except queue.Empty:
+                break
+
+        if not done:
+            root.after(50, poll, fut, out, mark)
+            return
+
+        if fut.exception() is not None:
+            logger.error(f"Query pipeline failed: {fut.exception()}")
+            output.insert(mark, f"Error: {fut.exception()}\n")
+        output.mark_unset(mark)
+
     def handle_query():
         user_query = input_box.get("1.0", tk.END).strip()
         if not user_query:
             return
 
         output.insert(tk.END, f"You: {user_query}\n\n")
-
-        sql, err = generate_sql_query(user_query)
-        if err:
-            output.insert(tk.END, f"Error: {err}\n\n")
-            return
-
-        output.insert(tk.END, f"SQL:\n{sql}\n\n")
-
-        rows, cols, db_err = execute_sql(sql)
-        if db_err:
-            output.insert(tk.END, f"DB Error: {db_err}\n\n")
-            return
-
-        answer = frame_answer(user_query, rows, cols)
-        output.insert(tk.END, f"Bot:\n{answer}\n\n")
-
         input_box.delete("1.0", tk.END)
 
+        # Each in-flight query writes at its own mark, placed before a
+        # trailing blank line, so concurrent answers stay grouped under
+        # their question instead of interleaving at the end
+        out = queue.Queue()
+        fut = _EXEC.submit(_pipeline, user_query, out)
+        mark = f"query-{id(fut)}"
+        output.mark_set(mark, "end-1c")
+        output.mark_gravity(mark, tk.LEFT)
+        output.insert(mark, "\n")
+        output.mark_gravity(mark, tk.RIGHT)
+        root.after(50, poll, fut, out, mark)
+
     root = tk.Tk()
     root.title("MySQL RAG Chatbot (Ollama)")
 
@@ -208,17 +432,6 @@ def chatbot_ui():
 
     tk.Button(root, text="Ask", command=handle_query).pack(pady=5)
     root.mainloop()
-    
-    
-    # ....................
-    
-print("DB_HOST:", DB_HOST)
-print("DB_PORT:", DB_PORT)
-print("DB_DATABASE:", DB_DATABASE)
-print("DB_USERNAME:", DB_USERNAME)
-    
-      
-
 
 # =========================================================
 # MAIN
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# =========================================================
+# Ollama client
+# =========================================================
+# One AsyncClient (and its pooled httpx connections) is reused for every
+# request. httpx connections are bound to the event loop that opened
+# them, so the client is only ever used from the batcher's loop.
+_ACLIENT = None
+
+def _client():
+    global _ACLIENT
+    if _ACLIENT is None:
+        import httpx
+        from ollama import AsyncClient
+
+        _ACLIENT = AsyncClient(
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=8)
+        )
+    return _ACLIENT
+
+
+# =========================================================
+# Micro-batcher
+# =========================================================
+# Prompts arriving within WINDOW seconds of each other (up to MAX_BATCH)
+# are sent to Ollama together. The batcher owns its own event loop on a
+# daemon thread so both the Tk UI thread and Streamlit script threads can
+# enqueue work.
+WINDOW = 0.010
+MAX_BATCH = 8
+
+
+class SQLBatcher:
+    def __init__(self, model="mistral", window=WINDOW, max_batch=MAX_BATCH):
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self._loop = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            ready = threading.Event()
+
+            def run():
+                self._loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self._loop)
+                self._queue = asyncio.Queue()
+                self._loop.create_task(self._worker())
+                ready.set()
+                self._loop.run_forever()
+
+            threading.Thread(target=run, name="sql-batcher", daemon=True).start()
+            ready.wait()
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _chat(self, prompt):
+        response = await _client().chat(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        return response["message"]["content"]
+
+    async def _worker(self):
+        pending = set()
+        while True:
+            batch = await self._collect()
+            logger.info(f"Dispatching batch of {len(batch)} prompt(s)")
+
+            # Keep collecting the next batch while this one is in flight
+            task = self._loop.create_task(self._dispatch(batch))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+    async def _dispatch(self, batch):
+        # Drop prompts whose caller already gave up; marking the rest as
+        # running means a later cancel() can no longer race set_result()
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        results = await asyncio.gather(
+            *[
+                self._chat(prompt) if on_chunk is None
+                else self._stream(prompt, on_chunk)
+                for prompt, _, on_chunk in batch
+            ],
+            return_exceptions=True
+        )
+
+        for (_, fut, _), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+    def submit_nowait(self, prompt: str, on_chunk=None) -> Future:
+        self._ensure_started()
+        fut = Future()
+        self._loop.call_soon_threadsafe(
+            self._queue.put_nowait, (prompt, fut, on_chunk)
+        )
+        return fut
+
+    async def submit(self, prompt: str) -> str:
+        return await asyncio.wrap_future(self.submit_nowait(prompt))
+
+    # Streamed prompts go through the same batch window; only the Ollama
+    # call differs. on_chunk is called from the batcher thread, so it must
+    # be thread-safe (e.g. queue.Queue.put).
+    async def _stream(self, prompt, on_chunk):
+        chunks = []
+        stream = await _client().chat(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True
+        )
+        async for part in stream:
+            text = part["message"]["content"]
+            chunks.append(text)
+            on_chunk(text)
+        return "".join(chunks)
+
+    async def stream(self, prompt: str, on_chunk) -> str:
+        return await asyncio.wrap_future(self.submit_nowait(prompt, on_chunk))
+
+
+batcher = SQLBatcher()
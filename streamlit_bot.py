@@ -1,21 +1,52 @@
 import os
 import json
 import mysql.connector
+from mysql.connector import pooling
 from dotenv import load_dotenv
-import ollama
+import asyncio
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import heapq
+from itertools import chain
+from contextlib import closing
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
 import re
+import queue
+import threading
+from sql_batcher import batcher
 import streamlit as st
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # =========================================================
 # Logging
 # =========================================================
-logging.basicConfig(
-    filename="chatbot.log",
-    filemode="a",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+# Records are handed to a QueueListener thread so the file write never
+# blocks the caller. The guard keeps reruns from stacking handlers.
+_root_logger = logging.getLogger()
+if not any(isinstance(h, QueueHandler) for h in _root_logger.handlers):
+    _file_handler = RotatingFileHandler(
+        "chatbot.log",
+        maxBytes=5 * 1024 * 1024,
+        backupCount=3,
+        encoding="utf-8"
+    )
+    _file_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+    _log_queue = queue.Queue(-1)
+    _log_listener = QueueListener(_log_queue, _file_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+    _root_logger.addHandler(QueueHandler(_log_queue))
+    _root_logger.setLevel(logging.INFO)
+
 logger = logging.getLogger(__name__)
 
 # =========================================================
@@ -32,75 +63,122 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 # =========================================================
 # Load Table Metadata
 # =========================================================
+# Shared across sessions and reruns; cleared by the "Refresh Cache" button
+@st.cache_resource
+def _load_metadata():
+    with open("table_metadata.json", "rb") as f:
+        raw = f.read()
+    metadata = orjson.loads(raw) if orjson else json.loads(raw)
+    if isinstance(metadata, dict):
+        metadata = [metadata]
+    return metadata
+
 try:
-    with open("table_metadata.json", "r", encoding="utf-8") as f:
-        TABLE_METADATA = json.load(f)
+    TABLE_METADATA = _load_metadata()
 except Exception as e:
     logger.critical(f"Failed to load table_metadata.json: {e}")
     st.error("table_metadata.json missing or corrupted")
     st.stop()
 
-if isinstance(TABLE_METADATA, dict):
-    TABLE_METADATA = [TABLE_METADATA]
-
 # =========================================================
 # Intent Detection
 # =========================================================
+_RANKING_RE = re.compile(
+    r"\b(top|highest|lowest|most|least|maximum|minimum"
+    r"|rank(?:s|ed|ing|ings)?|order(?:s|ed|ing)?)\b",
+    re.IGNORECASE
+)
+
 def is_ranking_query(query: str) -> bool:
-    return any(
-        k in query.lower()
-        for k in [
-            "top", "highest", "lowest", "most", "least",
-            "maximum", "minimum", "rank", "order"
-        ]
-    )
+    return _RANKING_RE.search(query) is not None
 
 # =========================================================
 # Table Selection
 # =========================================================
+def _table_keywords(table) -> frozenset:
+    table_name = str(table.get("table_name", "")).lower()
+    description = str(table.get("description", "")).lower()
+    columns = [
+        c["name"].lower() if isinstance(c, dict) else c.lower()
+        for c in table.get("columns", [])
+        if (isinstance(c, dict) and "name" in c) or isinstance(c, str)
+    ]
+    return frozenset(table_name.split() + description.split() + columns)
+
+# Every distinct keyword gets a bit, and each table becomes an int
+# bitmask, so scoring a query is an AND plus a popcount. Cached so reruns
+# skip the rebuild until the metadata itself changes.
+@st.cache_data
+def _build_keyword_masks(metadata):
+    vocab = {}
+    masks = [
+        sum(1 << vocab.setdefault(w, len(vocab)) for w in _table_keywords(t))
+        for t in metadata
+    ]
+    return vocab, masks
+
+_VOCAB, _masks = _build_keyword_masks(TABLE_METADATA)
+_TABLE_INDEX = list(zip(_masks, TABLE_METADATA))
+
+def _query_mask(query: str) -> int:
+    mask = 0
+    for w in query.lower().split():
+        bit = _VOCAB.get(w)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+# st.cache_data rather than lru_cache: the script (and any lru_cache in it)
+# is rebuilt on every rerun, so only Streamlit's cache sees repeat queries
+@st.cache_data(max_entries=1024, show_spinner=False)
 def select_relevant_tables(query: str):
-    query_words = set(query.lower().split())
-    scored = []
-
-    for table in TABLE_METADATA:
-        table_name = str(table.get("table_name", "")).lower()
-        description = str(table.get("description", "")).lower()
-
-        raw_columns = table.get("columns", [])
-        columns = []
-
-        for c in raw_columns:
-            if isinstance(c, dict) and "name" in c:
-                columns.append(c["name"].lower())
-            elif isinstance(c, str):
-                columns.append(c.lower())
-
-        keywords = set(table_name.split() + description.split() + columns)
-        score = len(query_words.intersection(keywords))
-
-        if score > 0:
-            scored.append((score, table))
+    qmask = _query_mask(query)
+    scored = [
+        ((qmask & mask).bit_count(), table)
+        for mask, table in _TABLE_INDEX
+        if qmask & mask
+    ]
 
     if not scored:
-        return TABLE_METADATA[:3]
+        return tuple(TABLE_METADATA[:3])
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [t for _, t in scored[:3]]
+    return tuple(t for _, t in heapq.nlargest(3, scored, key=lambda x: x[0]))
 
 # =========================================================
 # SQL Generation
 # =========================================================
-def generate_sql_query(user_query: str):
-    tables = select_relevant_tables(user_query)
+_FENCE_RE = re.compile(r"```.*?```", re.DOTALL)
+_SELECT_RE = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+
+_TABLE_BY_NAME = {t["table_name"]: t for t in TABLE_METADATA}
+
+# Cached with Streamlit for the same reason as select_relevant_tables
+@st.cache_data(max_entries=256, show_spinner=False)
+def _schema_for(table_names: tuple[str, ...]) -> str:
+    parts = ["MySQL Schema:"]
+    for name in table_names:
+        parts.append(f"\nTable: {name}")
+        parts.extend(
+            f"  - {c['name']} ({c.get('type','')})" if isinstance(c, dict)
+            else f"  - {c}"
+            for c in _TABLE_BY_NAME[name].get("columns", [])
+            if isinstance(c, (dict, str))
+        )
+    return "\n".join(parts)
+
+# Generated SQL is cached by cached_sql_query below, keyed by the
+# normalized question so repeats that differ only in case or whitespace
+# skip the Ollama round-trip
+SQL_CACHE_SIZE = 256
 
-    schema = "MySQL Schema:\n"
-    for t in tables:
-        schema += f"\nTable: {t['table_name']}\n"
-        for c in t.get("columns", []):
-            if isinstance(c, dict):
-                schema += f"  - {c['name']} ({c.get('type','')})\n"
-            elif isinstance(c, str):
-                schema += f"  - {c}\n"
+def _normalize_query(user_query: str) -> str:
+    return " ".join(user_query.lower().split())
+
+# Concurrent requests only overlap if the Ollama server allows it:
+#   OLLAMA_NUM_PARALLEL=4 OLLAMA_MAX_LOADED_MODELS=2 ollama serve
+async def generate_sql_query(user_query: str, on_chunk=None):
+    tables = select_relevant_tables(user_query)
+    schema = _schema_for(tuple(t["table_name"] for t in tables))
 
     prompt = f"""
 You are a senior MySQL expert.
@@ -118,35 +196,146 @@ Rules:
 """
 
     try:
-        response = ollama.chat(
-            model="mistral",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        sql = response["message"]["content"].strip()
-        sql = re.sub(r"```.*?```", "", sql, flags=re.DOTALL).strip()
+        if on_chunk is None:
+            sql = await batcher.submit(prompt)
+        else:
+            sql = await batcher.stream(prompt, on_chunk)
+
+        # Fences can span chunks, so strip them once the stream is complete
+        sql = _FENCE_RE.sub("", sql).strip()
+        if not _SELECT_RE.match(sql):
+            logger.warning(f"Rejected non-SELECT output: {sql}")
+            return None, "Generated query is not a SELECT statement"
         return sql, None
     except Exception as e:
         logger.error(f"Ollama error: {e}")
         return None, str(e)
 
+async def generate_sql_queries_bulk(queries: list[str]):
+    return await asyncio.gather(*[generate_sql_query(q) for q in queries])
+
+# Only `key` (the normalized question) is hashed; underscore-prefixed
+# arguments are ignored by st.cache_data, so the original wording still
+# goes into the prompt. Errors are raised rather than returned so that
+# failures are not cached.
+@st.cache_data(ttl=3600, max_entries=SQL_CACHE_SIZE, show_spinner=False)
+def cached_sql_query(key: str, _user_query: str, _on_chunk=None) -> str:
+    sql, err = asyncio.run(generate_sql_query(_user_query, on_chunk=_on_chunk))
+    if err:
+        raise RuntimeError(err)
+    return sql
+
+# st.write_stream needs a sync generator, and st calls inside a cached
+# function get replayed on cache hits, so the lookup runs on a worker
+# thread and hands tokens back through a queue. Cache hits yield nothing.
+def stream_sql_query(user_query: str, result: dict):
+    chunks = queue.Queue()
+
+    def run():
+        try:
+            result["sql"] = cached_sql_query(
+                _normalize_query(user_query), user_query, _on_chunk=chunks.put
+            )
+        except Exception as e:
+            result["error"] = str(e)
+        finally:
+            chunks.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    yield from iter(chunks.get, None)
+
 # =========================================================
 # Execute SQL
 # =========================================================
+# One pool for the whole server; a module global would be rebuilt on
+# every rerun
+@st.cache_resource
+def _get_pool():
+    return pooling.MySQLConnectionPool(
+        pool_name="rag",
+        pool_size=8,
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_DATABASE,
+        user=DB_USERNAME,
+        password=DB_PASSWORD,
+        # Drains rows left unread when a result stream is abandoned
+        consume_results=True,
+        # Keep sessions (and their prepared statements) intact when a
+        # connection goes back to the pool
+        pool_reset_session=False
+    )
+
+FETCH_SIZE = 1000
+PREPARED_PER_CONNECTION = 32
+
+# Physical connection -> (connection_id, {sql: prepared cursor}), shared
+# across reruns like the pool whose connections own the statements
+@st.cache_resource
+def _prepared_cursors():
+    return WeakKeyDictionary()
+
+def _statement_cache(conn):
+    # Keyed on the pooled wrapper's underlying connection, not the server
+    # session id: ids are reused after a server restart. A reconnect gives
+    # the same object a new session, whose statements start empty, so the
+    # stale cursors are dropped without being closed.
+    # PooledMySQLConnection has no public accessor for the underlying
+    # connection, and close() sets _cnx to None, so this must only be
+    # called while conn is checked out (i.e. before conn.close()).
+    cnx = conn._cnx
+    entry = _prepared_cursors().get(cnx)
+    if entry is None or entry[0] != cnx.connection_id:
+        entry = (cnx.connection_id, OrderedDict())
+        _prepared_cursors()[cnx] = entry
+    return entry[1]
+
+def _prepared_cursor(conn, sql: str):
+    # Re-executing the same text on a cached prepared cursor skips the
+    # server-side parse and plan
+    cache = _statement_cache(conn)
+    cursor = cache.pop(sql, None)
+    if cursor is None:
+        cursor = conn.cursor(prepared=True)
+        if len(cache) >= PREPARED_PER_CONNECTION:
+            _, evicted = cache.popitem(last=False)
+            evicted.close()
+    cache[sql] = cursor
+    return cursor
+
+def _discard_cursor(conn, sql: str, cursor):
+    _statement_cache(conn).pop(sql, None)
+    cursor.close()
+
+def _stream_rows(conn, cursor, sql: str):
+    # Closing the pooled connection returns it to the pool. The prepared
+    # cursor stays cached unless the stream was abandoned part-way.
+    exhausted = False
+    with closing(conn):
+        try:
+            yield from chain.from_iterable(
+                iter(lambda: cursor.fetchmany(FETCH_SIZE), [])
+            )
+            exhausted = True
+        finally:
+            if not exhausted:
+                _discard_cursor(conn, sql, cursor)
+
 def execute_sql(sql: str):
     try:
-        conn = mysql.connector.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_DATABASE,
-            user=DB_USERNAME,
-            password=DB_PASSWORD
-        )
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-        columns = [d[0] for d in cursor.description]
-        conn.close()
-        return rows, columns, None
+        conn = _get_pool().get_connection()
+        try:
+            cursor = _prepared_cursor(conn, sql)
+            try:
+                cursor.execute(sql)
+                columns = [d[0] for d in cursor.description]
+            except BaseException:
+                _discard_cursor(conn, sql, cursor)
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        return _stream_rows(conn, cursor, sql), columns, None
     except mysql.connector.Error as e:
         logger.error(f"MySQL error: {e}")
         return None, None, str(e)
@@ -155,17 +344,18 @@ def execute_sql(sql: str):
 # Answer Formatting
 # =========================================================
 def frame_answer(query, rows, cols):
-    if not rows:
-        return "No results found."
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        yield "No results found."
+        return
 
+    fmt_cell = "{0[0]}: {0[1]}".format
     ranking = is_ranking_query(query)
-    text = ""
 
-    for i, row in enumerate(rows, 1):
-        line = ", ".join(f"{c}: {v}" for c, v in zip(cols, row))
-        text += f"Rank {i}: {line}\n" if ranking else line + "\n"
-
-    return text.strip()
+    for i, row in enumerate(chain((first,), rows), 1):
+        line = ", ".join(map(fmt_cell, zip(cols, row)))
+        yield f"Rank {i}: {line}" if ranking else line
 
 # =========================================================
 # Streamlit UI — PERSONAL BOT
@@ -186,6 +376,11 @@ with st.sidebar:
     st.markdown("---")
     if st.button("Clear Chat"):
         st.session_state.chat = []
+    if st.button("Refresh Cache"):
+        cached_sql_query.clear()
+        _load_metadata.clear()
+        select_relevant_tables.clear()
+        _schema_for.clear()
 
 # Initialize chat history
 if "chat" not in st.session_state:
@@ -197,7 +392,13 @@ user_query = st.text_input("Ask your database question:")
 if st.button("Submit") and user_query:
     logger.info(f"User Query: {user_query}")
 
-    sql, err = generate_sql_query(user_query)
+    result = {}
+    placeholder = st.empty()
+    with placeholder:
+        st.write_stream(stream_sql_query(user_query, result))
+    placeholder.empty()
+    sql, err = result.get("sql"), result.get("error")
+
     if err:
         st.error(err)
     else:
@@ -205,12 +406,19 @@ if st.button("Submit") and user_query:
         if db_err:
             st.error(db_err)
         else:
-            answer = frame_answer(user_query, rows, cols)
-            st.session_state.chat.append({
-                "question": user_query,
-                "sql": sql,
-                "answer": answer
-            })
+            # Rows are fetched lazily, so a lost connection surfaces here
+            # rather than inside execute_sql
+            try:
+                answer = "\n".join(frame_answer(user_query, rows, cols))
+            except mysql.connector.Error as e:
+                logger.error(f"MySQL error: {e}")
+                st.error(str(e))
+            else:
+                st.session_state.chat.append({
+                    "question": user_query,
+                    "sql": sql,
+                    "answer": answer
+                })
 
 # Display chat history
 for chat in reversed(st.session_state.chat):